@@ -1,30 +1,116 @@
 import os
+import re
+import copy
+import json
+import asyncio
+import hashlib
+import shutil
 import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
+import numpy as np
 import requests
 from bs4 import BeautifulSoup
 import fitz  # PyMuPDF
 import spacy
 from collections import Counter
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, UploadFile, Form
+from fastapi import FastAPI, File, UploadFile, Form, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import google.generativeai as genai
-from sklearn.metrics.pairwise import cosine_similarity
 import difflib
 from sentence_transformers import SentenceTransformer  # ✅ local embeddings
-import time
 import random
 
+try:
+    import simsimd  # ✅ optional SIMD cosine kernels
+except ImportError:
+    simsimd = None
+
+try:
+    import bm25s  # ✅ optional sparse (BM25) retrieval
+except ImportError:
+    bm25s = None
+
+try:
+    import lxml  # noqa: F401  ✅ optional C HTML parser for BeautifulSoup
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+try:
+    import tiktoken  # ✅ optional tokenizer for prompt budgets
+except ImportError:
+    tiktoken = None
+
+try:
+    import ahocorasick  # ✅ optional multi-pattern matcher
+except ImportError:
+    ahocorasick = None
+
+try:
+    from rapidfuzz import fuzz, process  # ✅ optional C-accelerated fuzzy matching
+except ImportError:
+    fuzz = process = None
+
 # ===== Load environment variables =====
 load_dotenv()
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+CHAT_MODEL = genai.GenerativeModel("gemini-1.5-flash-latest")
+MAX_CTX_TOKENS = int(os.getenv("MAX_CTX_TOKENS", "1500"))
+MAX_HIST_TOKENS = int(os.getenv("MAX_HIST_TOKENS", "500"))
+
+# cl100k_base only approximates Gemini's tokenizer, which is fine for a budget
+if tiktoken is not None:
+    _ENC = tiktoken.get_encoding("cl100k_base")
+
+    def encode_tokens(text):
+        # user text may contain "<|endoftext|>"; count it as plain text
+        return _ENC.encode(text, disallowed_special=())
+
+    def decode_tokens(tokens):
+        return _ENC.decode(tokens)
+else:
+    # rough fallback: whitespace-delimited words
+    def encode_tokens(text):
+        return text.split()
+
+    def decode_tokens(tokens):
+        return " ".join(tokens)
 
 # ===== Load spaCy model =====
-nlp = spacy.load("en_core_web_sm")
+# ✅ only NER is used, so don't load the other pipes (ner has its own tok2vec)
+nlp = spacy.load("en_core_web_sm", exclude=["tok2vec", "tagger", "parser", "senter", "attribute_ruler", "lemmatizer"])
+SPACY_BATCH_SIZE = int(os.getenv("SPACY_BATCH_SIZE", "64"))
+# ✅ separate lightweight pipeline for sentence boundaries (chunking)
+nlp_sent = spacy.load("en_core_web_sm", exclude=["tok2vec", "tagger", "parser", "ner", "attribute_ruler", "lemmatizer"])
+nlp_sent.enable_pipe("senter")
 
 # ===== Load local embedding model =====
-local_embedder = SentenceTransformer("all-MiniLM-L6-v2")
+EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
+local_embedder = SentenceTransformer(EMBED_MODEL_NAME)
+EMBED_BATCH = int(os.getenv("EMBED_BATCH", "64"))
+EMBED_DIM = local_embedder.get_sentence_embedding_dimension()
+# ✅ chunk size is measured in embedder word pieces; anything past
+# max_seq_length (minus [CLS]/[SEP]) would be truncated and never embedded
+MAX_CHUNK_TOKENS = local_embedder.max_seq_length - 2
+CHUNK_TOKENS = min(int(os.getenv("CHUNK_TOKENS", str(MAX_CHUNK_TOKENS))), MAX_CHUNK_TOKENS)
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+# ✅ private tokenizer for counting: calling the embedder's shared one resets its
+# truncation/padding state under concurrent encode() calls. Its own lock keeps
+# two concurrent uploads from tripping "Already borrowed" on this copy.
+CHUNK_TOKENIZER = copy.deepcopy(local_embedder.tokenizer)
+CHUNK_TOKENIZER_LOCK = threading.Lock()
+# SimSIMD has fast int8 cosine kernels; NumPy matmul needs f32 to hit BLAS
+EMBED_DTYPE = np.int8 if simsimd is not None else np.float32
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR", "cache")
+RETRIEVE_CANDIDATES = int(os.getenv("RETRIEVE_CANDIDATES", "20"))
+RRF_K = 60
 
 # ===== FastAPI app =====
 app = FastAPI()
@@ -37,11 +123,105 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ===== Global Storage =====
-BOOK_TEXT = ""
-BOOK_CHUNKS = []
-BOOK_EMBEDDINGS = []
-CHAT_HISTORY = {}   # keep per-character history
+# ===== Character filter =====
+BANNED_KEYWORDS = [
+    "travels", "kingdom", "city", "island", "country",
+    "lord", "sir", "school", "hogwarts", "house", "place", "download"
+]
+
+if ahocorasick is not None:
+    _BAN = ahocorasick.Automaton()
+    for word in BANNED_KEYWORDS:
+        _BAN.add_word(word, word)
+    _BAN.make_automaton()
+
+    def has_banned_keyword(name):
+        return next(_BAN.iter(name.lower()), None) is not None
+else:
+    _BAN_RE = re.compile("|".join(map(re.escape, BANNED_KEYWORDS)), re.IGNORECASE)
+
+    def has_banned_keyword(name):
+        return _BAN_RE.search(name) is not None
+
+# ✅ 1-4 capitalized words; replaces the empty / long-phrase checks
+NAME_TOKEN = r"[^\W\d_](?:[^\W\d_]|['’\-]){1,30}"
+NAME_RE = re.compile(rf"^{NAME_TOKEN}(?:\s+{NAME_TOKEN}){{0,3}}$")
+
+def is_valid_name(name):
+    # re has no Unicode-uppercase class, so check the initials separately
+    return NAME_RE.match(name) is not None and all(word[0].isupper() for word in name.split())
+
+def is_similar_name(name, names, cutoff=0.85):
+    if process is not None:
+        return process.extractOne(name, names, scorer=fuzz.ratio, score_cutoff=cutoff * 100) is not None
+    return any(difflib.SequenceMatcher(None, name, x).ratio() > cutoff for x in names)
+
+# ===== Query cache =====
+class QueryCache:
+    """Ring buffer of recent query embeddings and the chunk ids retrieved for them."""
+
+    def __init__(self, size, dim, threshold=0.95):
+        self.vectors = np.zeros((size, dim), dtype=np.float32)
+        self.results = [None] * size
+        self.threshold = threshold
+        self.count = 0
+        self.pos = 0
+        # lookup/add run on worker threads; concurrent chats share a session
+        self.lock = threading.Lock()
+
+    def lookup(self, q_emb):
+        with self.lock:
+            if self.count == 0:
+                return None
+            sims = self.vectors[:self.count] @ q_emb
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                return self.results[best]
+            return None
+
+    def add(self, q_emb, result):
+        # ✅ overwrite the oldest entry once full
+        with self.lock:
+            self.vectors[self.pos] = q_emb
+            self.results[self.pos] = result
+            self.pos = (self.pos + 1) % len(self.results)
+            self.count = min(self.count + 1, len(self.results))
+
+def new_query_cache():
+    return QueryCache(
+        size=int(os.getenv("QUERY_CACHE_SIZE", "256")),
+        dim=EMBED_DIM,
+        threshold=float(os.getenv("QUERY_CACHE_THRESHOLD", "0.95")),
+    )
+
+# ===== Sessions =====
+@dataclass
+class Session:
+    text: str
+    chunks: list
+    emb: np.ndarray
+    bm25: object = None
+    history: dict = field(default_factory=dict)  # keep per-character history
+    query_cache: QueryCache = field(default_factory=new_query_cache)
+
+# ✅ one book + history per client, least recently used evicted first
+MAX_SESSIONS = int(os.getenv("MAX_SESSIONS", "100"))
+SESSIONS: "OrderedDict[str, Session]" = OrderedDict()
+SESS_LOCK = asyncio.Lock()
+
+async def get_session(session_id):
+    async with SESS_LOCK:
+        session = SESSIONS.get(session_id)
+        if session is not None:
+            SESSIONS.move_to_end(session_id)
+        return session
+
+async def put_session(session_id, session):
+    async with SESS_LOCK:
+        SESSIONS[session_id] = session
+        SESSIONS.move_to_end(session_id)
+        while len(SESSIONS) > MAX_SESSIONS:
+            SESSIONS.popitem(last=False)
 
 # ===== Data Models =====
 class UploadResponse(BaseModel):
@@ -57,101 +237,386 @@ class ChatResponse(BaseModel):
     reply: str
 
 # ===== Helpers =====
+WORKER_THREADS = int(os.getenv("WORKER_THREADS", "4"))
+POOL = None
+
+# ✅ CPU-bound work (parsing, NER, embedding, retrieval) goes to the shared
+# pool; network calls stay on asyncio.to_thread so they can't starve it
+async def run_cpu(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(POOL, partial(func, *args, **kwargs))
+
 def extract_text_from_pdf(file_path):
-    text = ""
-    pdf = fitz.open(file_path)
-    for page in pdf:
-        text += page.get_text()
-    pdf.close()
-    return text
+    with fitz.open(file_path) as pdf:
+        return "".join(page.get_text("text") for page in pdf)
+
+# ✅ keep-alive connection pool shared by all URL uploads
+HTTP_SESSION = requests.Session()
 
+# ✅ re-uploading the same URL skips the download and parse
+@lru_cache(maxsize=64)
 def extract_text_from_url(url):
-    resp = requests.get(url)
-    soup = BeautifulSoup(resp.text, "html.parser")
+    resp = HTTP_SESSION.get(url, timeout=15)
+    resp.raise_for_status()
+    soup = BeautifulSoup(resp.content, HTML_PARSER)
+    # drop non-content tags so scripts and styles are not embedded
+    for tag in soup(["script", "style", "noscript"]):
+        tag.decompose()
     return soup.get_text(separator=" ", strip=True)
 
-def split_into_chunks(text, size=2000):
-    return [text[i:i+size] for i in range(0, len(text), size)]
-
-# ✅ Local embedding instead of Gemini
+# Cut text into blocks below spaCy's max_length, preferring line breaks
+def iter_text_blocks(text, size=100_000):
+    start = 0
+    while start < len(text):
+        end = min(start + size, len(text))
+        if end < len(text):
+            cut = text.rfind("\n", start, end)
+            if cut <= start:
+                cut = text.rfind(" ", start, end)
+            if cut > start:
+                end = cut
+        yield text[start:end]
+        start = end
+
+def iter_sentences(text):
+    for doc in nlp_sent.pipe(iter_text_blocks(text), batch_size=SPACY_BATCH_SIZE):
+        sents = [sent.text.strip() for sent in doc.sents]
+        sents = [sent for sent in sents if sent]
+        if not sents:
+            continue
+        with CHUNK_TOKENIZER_LOCK:
+            token_ids = CHUNK_TOKENIZER(sents, add_special_tokens=False)["input_ids"]
+        for sent, ids in zip(sents, token_ids):
+            yield sent, len(ids)
+
+# ✅ Sentence-aware chunks of ~max_tokens with a trailing-sentence overlap
+def split_into_chunks(text, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP):
+    chunks = []
+    window = []  # (sentence, n_tokens)
+    n_tokens = 0
+    for sent, n in iter_sentences(text):
+        if window and n_tokens + n > max_tokens:
+            chunks.append(" ".join(s for s, _ in window))
+            # carry the last few sentences over, but always drop the first one
+            carry = []
+            carried = 0
+            for s, k in reversed(window[1:]):
+                if carried + k > overlap:
+                    break
+                carry.insert(0, (s, k))
+                carried += k
+            window, n_tokens = carry, carried
+            # the overlap must not push the new chunk past the limit
+            if n_tokens + n > max_tokens:
+                window, n_tokens = [], 0
+        window.append((sent, n))
+        n_tokens += n
+    if window:
+        chunks.append(" ".join(s for s, _ in window))
+    return chunks
+
+# ✅ Local embedding instead of Gemini (L2-normalized float32)
 def embed_text(text):
-    emb = local_embedder.encode([text])[0]
-    return emb.tolist()
+    emb = local_embedder.encode([text], convert_to_numpy=True, normalize_embeddings=True)[0]
+    return emb.astype(np.float32)
+
+# ✅ Embed all chunks in one batched encode call
+def embed_chunks(chunks):
+    if EMBED_POOL is not None and len(chunks) >= EMBED_POOL_MIN_CHUNKS:
+        # ✅ large books: spread batches across the CPU worker processes.
+        # The pool's queues are shared, so one upload at a time may use it.
+        with EMBED_POOL_LOCK:
+            emb = local_embedder.encode_multi_process(
+                chunks,
+                EMBED_POOL,
+                batch_size=EMBED_BATCH,
+                normalize_embeddings=True,
+            )
+        return to_storage_dtype(emb)
+    emb = local_embedder.encode(
+        chunks,
+        batch_size=EMBED_BATCH,
+        convert_to_numpy=True,
+        normalize_embeddings=True,
+        show_progress_bar=False,
+    )
+    return to_storage_dtype(emb)
+
+# ✅ Scalar int8 quantization; cosine ignores the scale factor
+def quantize_int8(emb):
+    emb = np.asarray(emb)
+    if emb.size == 0:  # e.g. a scanned PDF with no extractable text
+        return emb.astype(np.int8)
+    peak = np.max(np.abs(emb))
+    scale = 127.0 / peak if peak > 0 else 1.0
+    return np.round(emb * scale).astype(np.int8)
+
+def to_storage_dtype(emb):
+    if EMBED_DTYPE == np.int8:
+        emb = quantize_int8(emb)
+    return np.ascontiguousarray(emb, dtype=EMBED_DTYPE)
+
+# ✅ Content-hash key, so re-uploads of the same text reuse the stored index
+def book_cache_key(text):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{EMBED_MODEL_NAME}:{np.dtype(EMBED_DTYPE).name}:wp{CHUNK_TOKENS}:{CHUNK_OVERLAP}:".encode())
+    h.update(text.encode())
+    return h.hexdigest()
+
+# ✅ unique temp file per writer, then rename, so concurrent uploads never clash
+def write_atomic(path, write, mode="wb", **open_kwargs):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with open(fd, mode, **open_kwargs) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def build_bm25(chunks):
+    retriever = bm25s.BM25()
+    retriever.index(bm25s.tokenize(chunks, stopwords="en", show_progress=False), show_progress=False)
+    return retriever
+
+def load_or_build_bm25(key, chunks):
+    if bm25s is None or not chunks:
+        return None
+    bm25_path = os.path.join(EMBED_CACHE_DIR, f"{key}.bm25")
+    if os.path.isdir(bm25_path):
+        return bm25s.BM25.load(bm25_path, mmap=True)
+    retriever = build_bm25(chunks)
+    tmp_dir = tempfile.mkdtemp(dir=EMBED_CACHE_DIR, suffix=".tmp")
+    try:
+        retriever.save(tmp_dir)
+        os.rename(tmp_dir, bm25_path)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        # another upload of the same book got there first; use its copy
+        if not os.path.isdir(bm25_path):
+            raise
+        return bm25s.BM25.load(bm25_path, mmap=True)
+    return retriever
+
+def load_or_build_index(text):
+    key = book_cache_key(text)
+    emb_path = os.path.join(EMBED_CACHE_DIR, f"{key}.npy")
+    chunks_path = os.path.join(EMBED_CACHE_DIR, f"{key}.json")
+    if os.path.exists(emb_path) and os.path.exists(chunks_path):
+        with open(chunks_path, encoding="utf-8") as f:
+            chunks = json.load(f)
+        return chunks, np.load(emb_path, mmap_mode="r"), load_or_build_bm25(key, chunks)
+
+    chunks = split_into_chunks(text)
+    emb = embed_chunks(chunks)
+
+    # write to temp files first so a crash never leaves a half-written index
+    os.makedirs(EMBED_CACHE_DIR, exist_ok=True)
+    write_atomic(emb_path, lambda f: np.save(f, emb))
+    write_atomic(chunks_path, lambda f: json.dump(chunks, f), mode="w", encoding="utf-8")
+    return chunks, emb, load_or_build_bm25(key, chunks)
+
+# ✅ O(N) argpartition, then sort only the k selected scores
+def top_ids(scores, k):
+    k = min(k, scores.size)
+    if k == 0:
+        return []
+    ids = np.argpartition(-scores, k - 1)[:k]
+    return ids[np.argsort(-scores[ids])].tolist()
+
+def dense_ranking(session, q_emb, k):
+    if simsimd is not None:
+        q = to_storage_dtype(q_emb).reshape(1, -1)
+        dists = np.asarray(simsimd.cdist(q, session.emb, metric="cosine"), dtype=np.float32)[0]
+        sims = 1.0 - dists
+    else:
+        # ✅ rows are pre-normalized, so cosine is a plain dot product
+        sims = session.emb @ q_emb
+    return top_ids(sims, k)
 
-def semantic_search(query, top_k=3):
-    if not BOOK_EMBEDDINGS:
+def sparse_ranking(session, query, k):
+    if session.bm25 is None:
+        return []
+    k = min(k, len(session.chunks))
+    query_tokens = bm25s.tokenize(query, stopwords="en", show_progress=False)
+    results, scores = session.bm25.retrieve(query_tokens, k=k, show_progress=False)
+    # drop chunks that share no terms with the query
+    return [int(i) for i, score in zip(results[0], scores[0]) if score > 0]
+
+# ✅ Reciprocal-rank fusion of the dense and BM25 rankings
+def fuse_rankings(rankings, top_k):
+    fused = Counter()
+    for ranking in rankings:
+        for rank, i in enumerate(ranking):
+            fused[i] += 1.0 / (RRF_K + rank + 1)
+    return [i for i, _ in fused.most_common(top_k)]
+
+# ✅ q_emb is the query embedding, computed once and shared by cache + retrieval
+def semantic_search_by_vec(session, q_emb, query, top_k=3):
+    if len(session.emb) == 0:
         return []
-    q_emb = embed_text(query)
-    sims = cosine_similarity([q_emb], BOOK_EMBEDDINGS)[0]
-    top_ids = sims.argsort()[-top_k:][::-1]
-    return [BOOK_CHUNKS[i] for i in top_ids]
+    cached = session.query_cache.lookup(q_emb)
+    if cached is not None and len(cached) >= top_k:
+        return [session.chunks[i] for i in cached[:top_k]]
+    n_candidates = max(top_k, RETRIEVE_CANDIDATES)
+    ids = fuse_rankings(
+        [dense_ranking(session, q_emb, n_candidates), sparse_ranking(session, query, n_candidates)],
+        top_k,
+    )
+    session.query_cache.add(q_emb, ids)
+    return [session.chunks[i] for i in ids]
+
+def semantic_search(session, query, top_k=3):
+    return semantic_search_by_vec(session, embed_text(query), query, top_k)
+
+# ✅ Keep texts in order until the token budget is spent, cutting the last one
+def fit_to_budget(texts, budget):
+    kept = []
+    for text in texts:
+        if budget <= 0:
+            break
+        tokens = encode_tokens(text)
+        if len(tokens) > budget:
+            text = decode_tokens(tokens[:budget])
+        kept.append(text)
+        budget -= len(tokens)
+    return kept
+
+async def build_chat_prompt(session, chat):
+    q_emb = await run_cpu(embed_text, chat.message)
+    retrieved = await run_cpu(semantic_search_by_vec, session, q_emb, chat.message, 3)
+    relevant_context = "\n\n".join(fit_to_budget(retrieved, MAX_CTX_TOKENS))
+    character_history = session.history.setdefault(chat.character, [])
+    # newest turns first, so the budget drops the oldest ones
+    turns = [
+        f"User: {m['user']}\n{chat.character}: {m['ai']}"
+        for m in reversed(character_history[-5:])
+    ]
+    history = "\n".join(reversed(fit_to_budget(turns, MAX_HIST_TOKENS)))
+
+    prompt = f"""
+You are roleplaying as **{chat.character}** from the uploaded book.
+
+Stay in character. Speak in a natural conversational style.
+If the book does not provide enough info, politely say so.
+
+Conversation history:
+{history}
+
+Relevant book context:
+{relevant_context}
+
+---
+User: "{chat.message}"
+{chat.character}:
+"""
+    return prompt, character_history
+
+# ✅ SpaCy character detection only, over non-overlapping blocks so no mention counts twice
+def extract_person_names(text):
+    name_entities = []
+    for doc in nlp.pipe(iter_text_blocks(text, size=10_000), batch_size=SPACY_BATCH_SIZE):
+        for ent in doc.ents:
+            if ent.label_ == "PERSON" and len(ent.text.split()) <= 3:
+                name_entities.append(ent.text.strip())
+    return name_entities
 
 def filter_character_list(chars):
-    banned_keywords = [
-        "travels", "kingdom", "city", "island", "country",
-        "lord", "sir", "school", "hogwarts", "house", "place","Download"
-    ]
     clean = []
+    seen = set()
     for c in chars:
         name = c.strip()
-        if not name:
-            continue
-        if any(bad in name.lower() for bad in banned_keywords):
-            continue
-        if len(name.split()) > 4:  # ignore long phrases
+        if not is_valid_name(name) or has_banned_keyword(name):
             continue
 
         # ✅ only first name
         first_name = name.split()[0].title()
 
-        # ✅ fuzzy dedup (skip if very similar to existing name)
-        if any(difflib.SequenceMatcher(None, first_name, x).ratio() > 0.85 for x in clean):
+        # ✅ exact dedup on the lowercased name, then fuzzy dedup
+        key = first_name.lower()
+        if key in seen or is_similar_name(first_name, clean):
             continue
 
+        seen.add(key)
         clean.append(first_name)
 
     return clean
 
+# ===== Startup =====
+# opt-in multi-process encoding; only useful on CPU (GPU stays single-process)
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "1"))
+EMBED_POOL_MIN_CHUNKS = int(os.getenv("EMBED_POOL_MIN_CHUNKS", "1000"))
+EMBED_POOL = None
+EMBED_POOL_LOCK = threading.Lock()
+
+def warm_models():
+    local_embedder.encode(["warm"] * 8, batch_size=8, show_progress_bar=False)
+    list(nlp.pipe(["warm up"], batch_size=1))
+    list(nlp_sent.pipe(["warm up"], batch_size=1))
+
+@app.on_event("startup")
+async def startup():
+    global POOL, EMBED_POOL
+    POOL = ThreadPoolExecutor(max_workers=WORKER_THREADS)
+    # ✅ pay first-batch / allocation cost before the first request
+    await run_cpu(warm_models)
+    if EMBED_WORKERS > 1 and local_embedder.device.type == "cpu":
+        EMBED_POOL = local_embedder.start_multi_process_pool(target_devices=["cpu"] * EMBED_WORKERS)
+
+@app.on_event("shutdown")
+async def shutdown():
+    if EMBED_POOL is not None:
+        local_embedder.stop_multi_process_pool(EMBED_POOL)
+    if POOL is not None:
+        POOL.shutdown(wait=False)
+
 # ===== Routes =====
 @app.get("/")
 def root():
     return {"message": "Welcome to Character Chat API"}
 
 @app.post("/upload", response_model=UploadResponse)
-async def upload_file(file: UploadFile = File(None), url: str = Form(None)):
+async def upload_file(
+    file: UploadFile = File(None),
+    url: str = Form(None),
+    x_session_id: str = Header("default"),
+):
     print("upload called")
-    global BOOK_TEXT, BOOK_CHUNKS, BOOK_EMBEDDINGS, CHAT_HISTORY
     extracted_text = ""
 
     if file:
         with tempfile.NamedTemporaryFile(delete=False) as tmp:
             tmp.write(await file.read())
             tmp_path = tmp.name
-        extracted_text = extract_text_from_pdf(tmp_path)
+        extracted_text = await run_cpu(extract_text_from_pdf, tmp_path)
     elif url:
-        extracted_text = extract_text_from_url(url)
+        try:
+            extracted_text = await asyncio.to_thread(extract_text_from_url, url)
+        except (requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema,
+                requests.exceptions.InvalidURL) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid URL: {e}")
+        except requests.RequestException as e:
+            raise HTTPException(status_code=502, detail=f"Could not fetch URL: {e}")
     else:
         return UploadResponse(text_preview="", total_chars=0, characters=[])
 
-    BOOK_TEXT = extracted_text
-    BOOK_CHUNKS = split_into_chunks(BOOK_TEXT)
+    # ✅ Chunk + embed locally (or load from disk cache), off the event loop
+    chunks, emb, bm25 = await run_cpu(load_or_build_index, extracted_text)
 
-    # ✅ Embed locally
-    BOOK_EMBEDDINGS = [embed_text(chunk) for chunk in BOOK_CHUNKS]
-
-    # ✅ SpaCy character detection only
-    doc = nlp(extracted_text)
-    name_entities = [
-        ent.text.strip()
-        for ent in doc.ents
-        if ent.label_ == "PERSON" and len(ent.text.split()) <= 3
-    ]
+    name_entities = await run_cpu(extract_person_names, extracted_text)
     name_counts = Counter(name_entities)
     spacy_top = [name for name, count in name_counts.most_common(20) if count > 3]
 
     final_characters = filter_character_list(spacy_top)
 
-    CHAT_HISTORY = {c: [] for c in final_characters}  # reset history
+    # ✅ swap in a fresh session (new book, reset history and query cache)
+    await put_session(x_session_id, Session(
+        text=extracted_text,
+        chunks=chunks,
+        emb=emb,
+        bm25=bm25,
+        history={c: [] for c in final_characters},
+    ))
 
     preview = extracted_text[:500]
     return UploadResponse(text_preview=preview, total_chars=len(extracted_text), characters=final_characters)
@@ -159,59 +624,67 @@ async def upload_file(file: UploadFile = File(None), url: str = Form(None)):
 
 # ... (rest of your imports)
 
-@app.post("/chat", response_model=ChatResponse)
-async def chat_with_character(chat: ChatRequest):
-    global BOOK_TEXT, CHAT_HISTORY
-    if not BOOK_TEXT:
-        return ChatResponse(reply="Please upload a book or website first.")
-
-    relevant_context = semantic_search(chat.message, top_k=3)
-    history = "\n".join([
-        f"User: {m['user']}\n{chat.character}: {m['ai']}"
-        for m in CHAT_HISTORY.get(chat.character, [])[-5:]
-    ])
-
-    prompt = f"""
-You are roleplaying as **{chat.character}** from the uploaded book.
-
-Stay in character. Speak in a natural conversational style.
-If the book does not provide enough info, politely say so.
-
-Conversation history:
-{history}
-
-Relevant book context:
-{relevant_context}
-
----
-User: "{chat.message}"
-{chat.character}:
-"""
-
-    reply = ""
-    retries = 3
+# ✅ Run a blocking Gemini call with exponential backoff on rate limits.
+# Returns (result, None) on success or (None, error_reply) on failure.
+async def generate_with_retry(call, retries=3):
     delay = 1  # Initial delay in seconds
     for i in range(retries):
         try:
-            model = genai.GenerativeModel("gemini-1.5-flash-latest")
-            response = model.generate_content(prompt)
-            reply = response.text.strip()
-            # print("reply",reply)
-            break  # If successful, exit the loop
+            return await asyncio.to_thread(call), None
         except Exception as e:
             if "429" in str(e): # Check if the error is a rate limit error
                 print(f"Rate limit exceeded. Retrying in {delay} seconds.")
-                time.sleep(delay)
+                await asyncio.sleep(delay)
                 delay *= 2  # Exponential backoff
                 delay += random.uniform(0, 1) # Add jitter
             else:
-                reply = f"(⚠️ Error talking to model: {str(e)})"
-                break
-    else:
-        reply = "(⚠️ Error: The model is currently unavailable after multiple retries.)"
+                return None, f"(⚠️ Error talking to model: {str(e)})"
+    return None, "(⚠️ Error: The model is currently unavailable after multiple retries.)"
+
+@app.post("/chat", response_model=ChatResponse)
+async def chat_with_character(chat: ChatRequest, x_session_id: str = Header("default")):
+    session = await get_session(x_session_id)
+    if session is None or not session.text:
+        return ChatResponse(reply="Please upload a book or website first.")
+
+    prompt, character_history = await build_chat_prompt(session, chat)
 
+    reply, error = await generate_with_retry(lambda: CHAT_MODEL.generate_content(prompt).text.strip())
+    reply = error or reply
 
     if reply: # Only append to history if a reply was generated
-        CHAT_HISTORY[chat.character].append({"user": chat.message, "ai": reply})
+        character_history.append({"user": chat.message, "ai": reply})
+
+    return ChatResponse(reply=reply)
+
+
+@app.post("/chat/stream")
+async def stream_chat_with_character(chat: ChatRequest, x_session_id: str = Header("default")):
+    session = await get_session(x_session_id)
+    if session is None or not session.text:
+        return StreamingResponse(iter(["Please upload a book or website first."]), media_type="text/plain")
+
+    prompt, character_history = await build_chat_prompt(session, chat)
+
+    # ✅ send tokens as they arrive; the blocking iterator is advanced off the event loop
+    async def generate():
+        response, error = await generate_with_retry(partial(CHAT_MODEL.generate_content, prompt, stream=True))
+        if error:
+            yield error
+            return
+
+        parts = []
+        try:
+            chunks = iter(response)
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                parts.append(chunk.text)
+                yield chunk.text
+        except Exception as e:
+            yield f"(⚠️ Error talking to model: {str(e)})"
+            return
+
+        reply = "".join(parts).strip()
+        if reply:
+            character_history.append({"user": chat.message, "ai": reply})
 
-    return ChatResponse(reply=reply)
\ No newline at end of file
+    return StreamingResponse(generate(), media_type="text/plain")